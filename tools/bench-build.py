@@ -2,9 +2,15 @@
 
 import abc
 import argparse
+import atexit
 import collections
+import concurrent.futures
 import contextlib
 import dataclasses
+import functools
+import hashlib
+import itertools
+import json
 import math
 import os
 import pathlib
@@ -25,10 +31,16 @@ ROOT = pathlib.Path(__file__).parent / ".."
 
 BENCH_BUILD_DB = ROOT / "bench-build.db"
 
+PROBE_CACHE_PATH = ROOT / ".bench-build-cache.json"
+
 CPP_BUILD_DIR = "build"
+CPP_TEST_EXE = os.path.join(CPP_BUILD_DIR, "test", "quick-lint-js-test")
 
 MOLD_LINKER_EXE: typing.Optional[str] = shutil.which("mold")
 
+CCACHE_EXE: typing.Optional[str] = shutil.which("ccache")
+SCCACHE_EXE: typing.Optional[str] = shutil.which("sccache")
+
 LD64_LLD_LINKER_EXE: typing.Optional[pathlib.Path] = pathlib.Path(
     "/Users/strager/tmp/llvm/clang+llvm-15.0.6-arm64-apple-darwin21.0/bin/ld64.lld"
 )
@@ -55,10 +67,35 @@ def main() -> None:
     parser.add_argument("--list", action="store_true")
     parser.add_argument("--self-test", action="store_true")
     parser.add_argument("--iterations", type=int, default=3)
-    parser.add_argument("--warmup-iterations", type=int, default=2)
+    parser.add_argument(
+        "--warmup-iterations",
+        type=int,
+        help="default: 1 with --cxx-launcher or --rustc-wrapper, otherwise 2",
+    )
+    parser.add_argument(
+        "--cxx-launcher", choices=("none", "ccache", "sccache"), default="none"
+    )
+    parser.add_argument("--rustc-wrapper", choices=("none", "sccache"), default="none")
+    parser.add_argument(
+        "--log-file",
+        type=pathlib.Path,
+        help="append build and test output to this file instead of the terminal",
+    )
     parser.add_argument("filter", default="", nargs="?")
     args = parser.parse_args()
 
+    compiler_caches = {"none": None, "ccache": CCACHE_EXE, "sccache": SCCACHE_EXE}
+    cxx_launcher = compiler_caches[args.cxx_launcher]
+    if args.cxx_launcher != "none" and cxx_launcher is None:
+        parser.error(f"--cxx-launcher: {args.cxx_launcher} not found in PATH")
+    rustc_wrapper = compiler_caches[args.rustc_wrapper]
+    if args.rustc_wrapper != "none" and rustc_wrapper is None:
+        parser.error(f"--rustc-wrapper: {args.rustc_wrapper} not found in PATH")
+    if args.warmup_iterations is None:
+        # With a compiler cache, the first warmup iteration fills the cache.
+        uses_compiler_cache = cxx_launcher is not None or rustc_wrapper is not None
+        args.warmup_iterations = 1 if uses_compiler_cache else 2
+
     if args.self_test:
         test_loader = unittest.TestLoader()
         test_loader.loadTestsFromTestCase(TestDB)
@@ -74,19 +111,46 @@ def main() -> None:
         return
 
     if args.list:
-        profiler = Lister()
-    else:
+        profile_all(
+            Filterer(Lister(), filter=args.filter),
+            cxx_launcher=cxx_launcher,
+            rustc_wrapper=rustc_wrapper,
+            probe=False,
+        )
+        return
+
+    load_probe_cache()
+    atexit.register(save_probe_cache)
+    with contextlib.ExitStack() as exit_stack:
+        if args.log_file is not None:
+            set_command_log(exit_stack.enter_context(open(args.log_file, "a")))
+            exit_stack.callback(set_command_log, None)
         db = DB(BENCH_BUILD_DB)
         profiler = Profiler(
             warmup_iterations=args.warmup_iterations,
             iterations=args.iterations,
             db=db,
         )
-    profiler = Filterer(profiler, filter=args.filter)
+        profile_all(
+            Filterer(profiler, filter=args.filter),
+            cxx_launcher=cxx_launcher,
+            rustc_wrapper=rustc_wrapper,
+            probe=True,
+        )
+
 
+def profile_all(
+    profiler: "Filterer",
+    cxx_launcher: typing.Optional[str],
+    rustc_wrapper: typing.Optional[str],
+    probe: bool,
+) -> None:
     for cpp_root in ROOT.glob("cpp*"):
-        for cpp_config in find_cpp_configs(root=cpp_root):
+        for cpp_config in find_cpp_configs(
+            root=cpp_root, cxx_launcher=cxx_launcher, probe=probe
+        ):
             profiler.profile(CPPFullBenchmark(cpp_config))
+            profiler.profile(CPPFullWithoutConfigureBenchmark(cpp_config))
             profiler.profile(CPPHalfBenchmark(cpp_config))
             profiler.profile(CPPTestOnlyBenchmark(cpp_config))
             profiler.profile(
@@ -118,7 +182,9 @@ def main() -> None:
         lex_rs_path = find_unique_file(rust_root, "lex.rs")
         diagnostic_types_rs_path = find_unique_file(rust_root, "diagnostic_types.rs")
         test_utf_8_rs_path = find_unique_file(rust_root, "test_utf_8.rs")
-        for rust_config in find_rust_configs(root=rust_root):
+        for rust_config in find_rust_configs(
+            root=rust_root, rustc_wrapper=rustc_wrapper, probe=probe
+        ):
             profiler.profile(RustFullBenchmark(rust_config))
             profiler.profile(RustHalfBenchmark(rust_config))
             profiler.profile(RustTestOnlyBenchmark(rust_config))
@@ -151,6 +217,7 @@ class CPPConfig(typing.NamedTuple):
     cxx_flags: str
     link_flags: str
     pch: bool
+    cxx_launcher: typing.Optional[str] = None
 
     @property
     def c_compiler(self) -> pathlib.Path:
@@ -171,142 +238,148 @@ class CPPConfig(typing.NamedTuple):
         )
 
 
-def find_cpp_configs(root: pathlib.Path) -> typing.List[CPPConfig]:
-    cpp_configs = []
-
-    def try_add_cxx_config(config: CPPConfig) -> None:
-        if cxx_compiler_builds(
-            cxx_compiler=config.cxx_compiler,
-            flags=f"{config.cxx_flags} {config.link_flags}",
-        ):
-            cpp_configs.append(config)
-        if config.pch:
-            new_config = config._replace(
-                label=f"{config.label} -fpch-instantiate-templates",
-                cxx_flags=f"{config.cxx_flags} -fpch-instantiate-templates",
-            )
-            if cxx_compiler_builds(
-                cxx_compiler=new_config.cxx_compiler,
-                flags=f"{new_config.cxx_flags} {new_config.link_flags}",
-            ):
-                cpp_configs.append(new_config)
-
-    def try_add_cxx_configs(
-        label: str, cxx_compiler: pathlib.Path, cxx_flags: str, link_flags: str
-    ) -> None:
-        for g in ("", "-g0"):
-            for pch in (False, True):
-                label_suffix = (" PCH" if pch else "") + (" " if g else "") + g
-                try_add_cxx_config(
-                    CPPConfig(
-                        root=root,
-                        label=f"{label}{label_suffix}",
-                        cxx_compiler=cxx_compiler,
-                        cxx_flags=f"{cxx_flags} {g}",
-                        link_flags=link_flags,
-                        pch=pch,
-                    )
-                )
-                if MOLD_LINKER_EXE is not None:
-                    try_add_cxx_config(
-                        CPPConfig(
-                            root=root,
-                            label=f"{label}{label_suffix} Mold",
-                            cxx_compiler=cxx_compiler,
-                            cxx_flags=f"{cxx_flags} {g}",
-                            # NOTE(strager): We can't write MOLD_LINKER_EXE here
-                            # because GCC only accepts exactly 'fuse-ld=mold'
-                            # (not a path to mold).
-                            # NOTE(strager): This only works if an executable
-                            # called 'ld.mold' is in PATH. It can't be called
-                            # just 'mold'.
-                            link_flags=f"{link_flags} -fuse-ld=mold",
-                            pch=pch,
-                        )
-                    )
-                if ZLD_LINKER_EXE is not None:
-                    try_add_cxx_config(
-                        CPPConfig(
-                            root=root,
-                            label=f"{label}{label_suffix} zld",
-                            cxx_compiler=cxx_compiler,
-                            cxx_flags=f"{cxx_flags} {g}",
-                            link_flags=f"{link_flags} -fuse-ld={ZLD_LINKER_EXE}",
-                            pch=pch,
-                        )
-                    )
-                if LD64_LLD_LINKER_EXE is not None:
-                    try_add_cxx_config(
-                        CPPConfig(
-                            root=root,
-                            label=f"{label}{label_suffix} ld64.lld",
-                            cxx_compiler=cxx_compiler,
-                            cxx_flags=f"{cxx_flags} {g}",
-                            link_flags=f"{link_flags} -fuse-ld={LD64_LLD_LINKER_EXE}",
-                            pch=pch,
-                        )
-                    )
-
-    def try_add_clang_configs(
-        label: str,
-        cxx_compiler: pathlib.Path,
-        cxx_flags: str = "",
-        link_flags: str = "",
-    ) -> None:
-        try_add_cxx_configs(
-            label=f"{label} libstdc++",
+# (label, cxx_compiler, cxx_flags, link_flags, family)
+CPP_COMPILERS: typing.List[typing.Tuple[str, pathlib.Path, str, str, str]] = [
+    ("Clang 12", pathlib.Path("clang++-12"), "", "", "clang"),
+    ("Clang 14", pathlib.Path("clang++-14"), "", "", "clang"),
+    (
+        "Clang Custom",
+        pathlib.Path("/home/strager/Toolchains/clang-stage2/bin/clang++"),
+        "",
+        "",
+        "clang",
+    ),
+    (
+        "Clang Custom PGO",
+        pathlib.Path("/home/strager/Toolchains/clang-stage4-qljs/bin/clang++"),
+        "",
+        "",
+        "clang",
+    ),
+    (
+        "Clang Custom PGO BOLT",
+        pathlib.Path("/home/strager/Toolchains/clang-stage4-qljs-bolt/bin/clang++"),
+        "",
+        "",
+        "clang",
+    ),
+    ("Clang", pathlib.Path("clang++"), "", "", "clang"),
+    (
+        "Clang 15",
+        pathlib.Path(
+            "/Users/strager/tmp/llvm/clang+llvm-15.0.6-arm64-apple-darwin21.0/bin/clang++"
+        ),
+        "-isystem /Users/strager/tmp/llvm/clang+llvm-15.0.6-arm64-apple-darwin21.0/include/c++/v1/ "
+        + "-isystem /Users/strager/Applications/Xcode_14.app/Contents/Developer/Platforms/MacOSX.platform/Developer/SDKs/MacOSX.sdk/usr/include/",
+        "-L/Users/strager/tmp/llvm/clang+llvm-15.0.6-arm64-apple-darwin21.0/lib/ "
+        + "-L/Users/strager/Applications/Xcode_14.app/Contents/Developer/Platforms/MacOSX.platform/Developer/SDKs/MacOSX.sdk/usr/lib/",
+        "clang",
+    ),
+    ("GCC 12", pathlib.Path("g++-12"), "", "", "gcc"),
+]
+
+# family -> [(label suffix, cxx_flags)]
+CPP_STDLIBS: typing.Dict[str, typing.List[typing.Tuple[str, str]]] = {
+    "clang": [(" libstdc++", "-stdlib=libstdc++"), (" libc++", "-stdlib=libc++")],
+    "gcc": [("", "")],
+}
+
+CPP_DEBUG_INFO_FLAGS: typing.Tuple[str, ...] = ("", "-g0")
+
+# [(label suffix, link_flags)]
+CPP_LINKERS: typing.List[typing.Tuple[str, str]] = [("", "")]
+if MOLD_LINKER_EXE is not None:
+    # NOTE(strager): We can't write MOLD_LINKER_EXE here because GCC only
+    # accepts exactly 'fuse-ld=mold' (not a path to mold).
+    # NOTE(strager): This only works if an executable called 'ld.mold' is in
+    # PATH. It can't be called just 'mold'.
+    CPP_LINKERS.append((" Mold", "-fuse-ld=mold"))
+if ZLD_LINKER_EXE is not None:
+    CPP_LINKERS.append((" zld", f"-fuse-ld={ZLD_LINKER_EXE}"))
+if LD64_LLD_LINKER_EXE is not None:
+    CPP_LINKERS.append((" ld64.lld", f"-fuse-ld={LD64_LLD_LINKER_EXE}"))
+
+
+# If probe is False, every candidate config is returned without checking
+# whether its compiler works.
+def find_cpp_configs(
+    root: pathlib.Path,
+    cxx_launcher: typing.Optional[str] = None,
+    probe: bool = True,
+) -> typing.List[CPPConfig]:
+    candidate_configs = [
+        CPPConfig(
+            root=root,
+            label=(
+                f"{compiler_label}{stdlib_label}"
+                + (" PCH" if pch else "")
+                + (f" {debug_info_flags}" if debug_info_flags else "")
+                + linker_label
+                + (" -fpch-instantiate-templates" if pch_instantiate_templates else "")
+            ),
             cxx_compiler=cxx_compiler,
-            cxx_flags=f"{cxx_flags} -stdlib=libstdc++",
-            link_flags=link_flags,
+            cxx_flags=join_flags(
+                compiler_cxx_flags,
+                stdlib_cxx_flags,
+                debug_info_flags,
+                "-fpch-instantiate-templates" if pch_instantiate_templates else "",
+            ),
+            link_flags=join_flags(compiler_link_flags, linker_link_flags),
+            pch=pch,
         )
-        try_add_cxx_configs(
-            label=f"{label} libc++",
-            cxx_compiler=cxx_compiler,
-            cxx_flags=f"{cxx_flags} -stdlib=libc++",
-            link_flags=link_flags,
+        for (
+            compiler_label,
+            cxx_compiler,
+            compiler_cxx_flags,
+            compiler_link_flags,
+            family,
+        ) in CPP_COMPILERS
+        for (stdlib_label, stdlib_cxx_flags) in CPP_STDLIBS[family]
+        for (
+            debug_info_flags,
+            pch,
+            (linker_label, linker_link_flags),
+            pch_instantiate_templates,
+        ) in itertools.product(
+            CPP_DEBUG_INFO_FLAGS, (False, True), CPP_LINKERS, (False, True)
         )
+        if pch or not pch_instantiate_templates
+    ]
+
+    if probe:
+        # Probe in parallel. Each probe runs the compiler.
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=os.cpu_count()
+        ) as executor:
+            probed_configs = list(executor.map(probe_cxx_config, candidate_configs))
+        cpp_configs = [config for config in probed_configs if config is not None]
+    else:
+        cpp_configs = candidate_configs
 
-    try_add_clang_configs(label="Clang 12", cxx_compiler=pathlib.Path("clang++-12"))
-    try_add_clang_configs(label="Clang 14", cxx_compiler=pathlib.Path("clang++-14"))
-    try_add_clang_configs(
-        label="Clang Custom",
-        cxx_compiler=pathlib.Path("/home/strager/Toolchains/clang-stage2/bin/clang++"),
-    )
-    try_add_clang_configs(
-        label="Clang Custom PGO",
-        cxx_compiler=pathlib.Path(
-            "/home/strager/Toolchains/clang-stage4-qljs/bin/clang++"
-        ),
-    )
-    try_add_clang_configs(
-        label="Clang Custom PGO BOLT",
-        cxx_compiler=pathlib.Path(
-            "/home/strager/Toolchains/clang-stage4-qljs-bolt/bin/clang++"
-        ),
-    )
-    try_add_clang_configs(
-        label="Clang",
-        cxx_compiler=pathlib.Path("clang++"),
-    )
-    try_add_clang_configs(
-        label="Clang 15",
-        cxx_compiler=pathlib.Path(
-            "/Users/strager/tmp/llvm/clang+llvm-15.0.6-arm64-apple-darwin21.0/bin/clang++"
-        ),
-        cxx_flags="-isystem /Users/strager/tmp/llvm/clang+llvm-15.0.6-arm64-apple-darwin21.0/include/c++/v1/ "
-        + "-isystem /Users/strager/Applications/Xcode_14.app/Contents/Developer/Platforms/MacOSX.platform/Developer/SDKs/MacOSX.sdk/usr/include/ ",
-        link_flags="-L/Users/strager/tmp/llvm/clang+llvm-15.0.6-arm64-apple-darwin21.0/lib/ "
-        + "-L/Users/strager/Applications/Xcode_14.app/Contents/Developer/Platforms/MacOSX.platform/Developer/SDKs/MacOSX.sdk/usr/lib/ ",
-    )
-    try_add_cxx_configs(
-        label="GCC 12",
-        cxx_compiler=pathlib.Path("g++-12"),
-        cxx_flags="",
-        link_flags="",
-    )
+    if cxx_launcher is not None:
+        cpp_configs = [
+            config._replace(
+                label=f"{config.label} {pathlib.Path(cxx_launcher).name}",
+                cxx_launcher=cxx_launcher,
+            )
+            for config in cpp_configs
+        ]
     return cpp_configs
 
 
+def join_flags(*flags: str) -> str:
+    return " ".join(flag for flag in flags if flag)
+
+
+def probe_cxx_config(config: CPPConfig) -> typing.Optional[CPPConfig]:
+    if cxx_compiler_builds(
+        cxx_compiler=config.cxx_compiler,
+        flags=f"{config.cxx_flags} {config.link_flags}",
+    ):
+        return config
+    return None
+
+
 class Benchmark:
     project: str
     toolchain_label: str
@@ -359,6 +432,22 @@ class CPPFullBenchmark(CPPBenchmarkBase):
         cpp_test(self._cpp_config)
 
 
+class CPPFullWithoutConfigureBenchmark(CPPBenchmarkBase):
+    name = "full build and test without configure"
+
+    def before_all_untimed(self) -> None:
+        cpp_clean(self._cpp_config)
+        cpp_configure(self._cpp_config)
+
+    def before_each_untimed(self) -> None:
+        # Delete build outputs but keep CMake's cache and generated build files.
+        cpp_build(self._cpp_config, targets=["clean"])
+
+    def run_timed(self) -> None:
+        cpp_build(self._cpp_config, targets=["quick-lint-js-test"])
+        cpp_test(self._cpp_config)
+
+
 class CPPHalfBenchmark(CPPBenchmarkBase):
     name = "build and test only my code"
 
@@ -421,7 +510,13 @@ def cpp_clean(cpp_config: CPPConfig) -> None:
 
 
 def cpp_configure(cpp_config: CPPConfig) -> None:
-    subprocess.check_call(
+    launcher_args = []
+    if cpp_config.cxx_launcher is not None:
+        launcher_args = [
+            f"-DCMAKE_C_COMPILER_LAUNCHER={cpp_config.cxx_launcher}",
+            f"-DCMAKE_CXX_COMPILER_LAUNCHER={cpp_config.cxx_launcher}",
+        ]
+    check_call(
         [
             "cmake",
             "-S",
@@ -436,21 +531,20 @@ def cpp_configure(cpp_config: CPPConfig) -> None:
             f"-DCMAKE_EXE_LINKER_FLAGS={cpp_config.link_flags}",
             f"-DCMAKE_SHARED_LINKER_FLAGS={cpp_config.link_flags}",
             f"-DQUICK_LINT_JS_PRECOMPILE_HEADERS={'YES' if cpp_config.pch else 'NO'}",
-        ],
+        ]
+        + launcher_args,
         cwd=cpp_config.root,
     )
 
 
 def cpp_build(cpp_config: CPPConfig, targets: typing.List[str] = []) -> None:
-    subprocess.check_call(
-        ["ninja", "-C", cpp_config.root / CPP_BUILD_DIR, "--"] + targets
+    check_call(
+        ["ninja", "-C", os.path.join(cpp_config.root, CPP_BUILD_DIR), "--"] + targets
     )
 
 
 def cpp_test(cpp_config: CPPConfig) -> None:
-    subprocess.check_call(
-        [cpp_config.root / CPP_BUILD_DIR / "test" / "quick-lint-js-test"]
-    )
+    check_call([os.path.join(cpp_config.root, CPP_TEST_EXE)])
 
 
 class RustConfig(typing.NamedTuple):
@@ -460,6 +554,8 @@ class RustConfig(typing.NamedTuple):
     cargo_profile: typing.Optional[str]
     rustflags: str
     nextest: bool
+    incremental: bool = True
+    rustc_wrapper: typing.Optional[str] = None
 
     @property
     def rustc(self) -> pathlib.Path:
@@ -467,11 +563,33 @@ class RustConfig(typing.NamedTuple):
         return self.cargo.parent / ("rustc-clif" if is_clif else "rustc")
 
 
-def find_rust_configs(root: pathlib.Path) -> typing.List[RustConfig]:
+# If probe is False, every candidate config is returned without looking for its
+# toolchain. The cargo path of such configs might be a placeholder.
+def find_rust_configs(
+    root: pathlib.Path,
+    rustc_wrapper: typing.Optional[str] = None,
+    probe: bool = True,
+) -> typing.List[RustConfig]:
     rust_configs = []
 
+    if probe:
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=os.cpu_count()
+        ) as executor:
+            stable_cargo, nightly_cargo = executor.map(
+                lambda toolchain: rustup_which("cargo", toolchain=toolchain),
+                ("stable", "nightly"),
+            )
+    else:
+        stable_cargo = nightly_cargo = pathlib.Path("cargo")
+
     def try_add_rust_config(config: RustConfig) -> None:
-        if config.cargo.exists():
+        if rustc_wrapper is not None:
+            config = config._replace(
+                label=f"{config.label} {pathlib.Path(rustc_wrapper).name}",
+                rustc_wrapper=rustc_wrapper,
+            )
+        if not probe or config.cargo.exists():
             rust_configs.append(config)
 
     def add_rust_configs_for_toolchain(
@@ -479,6 +597,7 @@ def find_rust_configs(root: pathlib.Path) -> typing.List[RustConfig]:
         cargo: pathlib.Path,
         cargo_profile: typing.Optional[str],
         rustflags: str,
+        incremental: bool,
     ) -> None:
         try_add_rust_config(
             RustConfig(
@@ -487,6 +606,7 @@ def find_rust_configs(root: pathlib.Path) -> typing.List[RustConfig]:
                 cargo=cargo,
                 cargo_profile=cargo_profile,
                 rustflags=rustflags,
+                incremental=incremental,
                 nextest=False,
             )
         )
@@ -497,6 +617,7 @@ def find_rust_configs(root: pathlib.Path) -> typing.List[RustConfig]:
                 cargo=cargo,
                 cargo_profile=cargo_profile,
                 rustflags=rustflags,
+                incremental=incremental,
                 nextest=True,
             )
         )
@@ -505,36 +626,42 @@ def find_rust_configs(root: pathlib.Path) -> typing.List[RustConfig]:
         extra_label: str,
         cargo_profile: typing.Optional[str],
         rustflags: str,
+        incremental: bool,
     ) -> None:
         add_rust_configs_for_toolchain(
             label=f"Rust Stable {extra_label}".rstrip(),
-            cargo=rustup_which("cargo", toolchain="stable"),
+            cargo=stable_cargo,
             cargo_profile=cargo_profile,
             rustflags=rustflags,
+            incremental=incremental,
         )
         add_rust_configs_for_toolchain(
             label=f"Rust Nightly {extra_label}".rstrip(),
-            cargo=rustup_which("cargo", toolchain="nightly"),
+            cargo=nightly_cargo,
             cargo_profile=cargo_profile,
             rustflags=rustflags,
+            incremental=incremental,
         )
         add_rust_configs_for_toolchain(
             label=f"Rust Nightly {extra_label} -Zshare-generics=y".rstrip(),
-            cargo=rustup_which("cargo", toolchain="nightly"),
+            cargo=nightly_cargo,
             cargo_profile=cargo_profile,
             rustflags=f"{rustflags} -Zshare-generics=y",
+            incremental=incremental,
         )
         add_rust_configs_for_toolchain(
             label=f"Rust Custom {extra_label}".rstrip(),
             cargo=pathlib.Path("/home/strager/Toolchains/rustc-stage2/bin/cargo"),
             cargo_profile=cargo_profile,
             rustflags=rustflags,
+            incremental=incremental,
         )
         add_rust_configs_for_toolchain(
             label=f"Rust Custom PGO {extra_label}".rstrip(),
             cargo=pathlib.Path("/home/strager/Toolchains/rustc-stage4-pgo/bin/cargo"),
             cargo_profile=cargo_profile,
             rustflags=rustflags,
+            incremental=incremental,
         )
         add_rust_configs_for_toolchain(
             label=f"Rust Custom PGO BOLT {extra_label}".rstrip(),
@@ -543,6 +670,7 @@ def find_rust_configs(root: pathlib.Path) -> typing.List[RustConfig]:
             ),
             cargo_profile=cargo_profile,
             rustflags=rustflags,
+            incremental=incremental,
         )
         if CARGO_CLIF_EXE is not None:
             add_rust_configs_for_toolchain(
@@ -550,13 +678,17 @@ def find_rust_configs(root: pathlib.Path) -> typing.List[RustConfig]:
                 cargo=CARGO_CLIF_EXE,
                 cargo_profile=cargo_profile,
                 rustflags=rustflags,
+                incremental=incremental,
             )
 
-    for cargo_profile in (
-        None,
-        "quick-build-incremental",
-        "quick-build-nonincremental",
+    for cargo_profile, incremental in (
+        (None, True),
+        (None, False),
+        ("quick-build-incremental", True),
+        ("quick-build-nonincremental", False),
     ):
+        # The quick-build-* profiles already say whether they are incremental.
+        profile_label = cargo_profile or ("" if incremental else "CARGO_INCREMENTAL=0")
         rustflags = ""
         if cargo_profile in (
             "quick-build-incremental",
@@ -568,27 +700,33 @@ def find_rust_configs(root: pathlib.Path) -> typing.List[RustConfig]:
             # profile-specific rustflags are unstable.
             rustflags = f"{rustflags} -Clink-args=-Wl,-s"
         add_rust_configs(
-            extra_label=f"{cargo_profile or ''}",
+            extra_label=f"{profile_label}",
             cargo_profile=cargo_profile,
             rustflags=rustflags,
+            incremental=incremental,
         )
         if MOLD_LINKER_EXE is not None:
+            # NOTE: rustc links with 'cc', which might be GCC. See the
+            # NOTE on CPP_LINKERS about -fuse-ld=mold.
             add_rust_configs(
-                extra_label=f"Mold {cargo_profile or ''}",
+                extra_label=f"Mold {profile_label}",
                 cargo_profile=cargo_profile,
-                rustflags=f"{rustflags} -Clink-arg=-fuse-ld={MOLD_LINKER_EXE}",
+                rustflags=f"{rustflags} -Clink-arg=-fuse-ld=mold",
+                incremental=incremental,
             )
         if ZLD_LINKER_EXE is not None:
             add_rust_configs(
-                extra_label=f"zld {cargo_profile or ''}",
+                extra_label=f"zld {profile_label}",
                 cargo_profile=cargo_profile,
                 rustflags=f"{rustflags} -Clink-arg=-fuse-ld={ZLD_LINKER_EXE}",
+                incremental=incremental,
             )
         if LD64_LLD_LINKER_EXE is not None:
             add_rust_configs(
-                extra_label=f"ld64.lld {cargo_profile or ''}",
+                extra_label=f"ld64.lld {profile_label}",
                 cargo_profile=cargo_profile,
                 rustflags=f"{rustflags} -Clink-arg=-fuse-ld={LD64_LLD_LINKER_EXE}",
+                incremental=incremental,
             )
     return reversed(rust_configs)
 
@@ -682,7 +820,7 @@ def rust_clean(root: pathlib.Path) -> None:
 
 
 def rust_download_dependencies(rust_config: RustConfig) -> None:
-    subprocess.check_call([rust_config.cargo, "fetch"], cwd=rust_config.root)
+    check_call([rust_config.cargo, "fetch"], cwd=rust_config.root)
 
 
 def rust_build_packages(rust_config: RustConfig, packages: typing.List[str]) -> None:
@@ -715,13 +853,10 @@ def rust_build_packages(rust_config: RustConfig, packages: typing.List[str]) ->
         old_manifest_text = None
 
     try:
-        subprocess.check_call(
+        check_call(
             command,
             cwd=rust_config.root,
-            env=dict(
-                os.environ,
-                RUSTC=str(rust_config.rustc),
-            ),
+            env=rust_env(rust_config),
         )
     finally:
         if old_manifest_text is not None:
@@ -737,14 +872,28 @@ def rust_build_and_test(rust_config: RustConfig) -> None:
         command = [rust_config.cargo, "test"]
         if rust_config.cargo_profile is not None:
             command.append(f"--profile={rust_config.cargo_profile}")
-    subprocess.check_call(
+    check_call(
         command,
         cwd=rust_config.root,
-        env=dict(
-            os.environ,
-            RUSTC=str(rust_config.rustc),
-        ),
+        env=rust_env(rust_config),
+    )
+
+
+# The returned dict is shared between callers. Do not modify it.
+@functools.lru_cache(maxsize=None)
+def rust_env(rust_config: RustConfig) -> typing.Dict[str, str]:
+    env = dict(
+        os.environ,
+        CARGO_TERM_COLOR="never",
+        # Always set this so an inherited CARGO_INCREMENTAL doesn't change what
+        # is measured.
+        CARGO_INCREMENTAL="1" if rust_config.incremental else "0",
+        RUSTC=str(rust_config.rustc),
+        RUSTFLAGS=rust_config.rustflags.strip(),
     )
+    if rust_config.rustc_wrapper is not None:
+        env["RUSTC_WRAPPER"] = rust_config.rustc_wrapper
+    return env
 
 
 class Lister:
@@ -790,6 +939,7 @@ class Profiler:
             self._profile_one(benchmark, run_id=None)
         for _ in range(self._iterations):
             self._profile_one(benchmark, run_id=run_id)
+        self._db.flush()
 
         benchmark.after_all_untimed()
 
@@ -798,15 +948,27 @@ class Profiler:
     ) -> None:
         benchmark.before_each_untimed()
 
-        before_ns = time.monotonic_ns()
+        before_times = os.times()
+        before_ns = time.perf_counter_ns()
         benchmark.run_timed()
-        after_ns = time.monotonic_ns()
+        after_ns = time.perf_counter_ns()
+        after_times = os.times()
 
         benchmark.after_each_untimed()
 
         if run_id is not None:
             duration_ns: NanosecondDuration = after_ns - before_ns
-            self._db.add_sample_to_run(run_id=run_id, duration_ns=duration_ns)
+            # os.times() only counts children which have been waited for, which
+            # is every process run by run_timed.
+            user_ns: NanosecondDuration = round(
+                (after_times.children_user - before_times.children_user) * 1e9
+            )
+            sys_ns: NanosecondDuration = round(
+                (after_times.children_system - before_times.children_system) * 1e9
+            )
+            self._db.add_sample_to_run(
+                run_id=run_id, duration_ns=duration_ns, user_ns=user_ns, sys_ns=sys_ns
+            )
 
     def dump_results(self) -> None:
         self._db.dump_runs(self._db.load_runs_by_ids(self._run_ids))
@@ -814,14 +976,14 @@ class Profiler:
 
 class Filterer:
     _profiler: typing.Union[Profiler, Lister]
-    _filter: str
+    _filter: typing.Pattern[str]
 
     def __init__(self, profiler: typing.Union[Profiler, Lister], filter: str):
         self._profiler = profiler
-        self._filter = filter
+        self._filter = re.compile(filter)
 
     def profile(self, benchmark: Benchmark) -> None:
-        if re.search(self._filter, benchmark.full_name):
+        if self._filter.search(benchmark.full_name):
             self._profiler.profile(benchmark)
 
     def timed(self):
@@ -831,7 +993,25 @@ class Filterer:
         self._profiler.dump_results()
 
 
+@functools.lru_cache(maxsize=None)
 def rustup_which(command: str, *, toolchain: str) -> pathlib.Path:
+    cache_key = probe_cache_key("rustup_which", command, toolchain)
+    cached = PROBE_CACHE.get(cache_key, None)
+    if cached is not None:
+        mtime_ns = get_mtime_ns(cached["value"])
+        if mtime_ns is not None and mtime_ns == cached["mtime_ns"]:
+            return pathlib.Path(cached["value"])
+
+    result = rustup_which_uncached(command, toolchain=toolchain)
+    mtime_ns = get_mtime_ns(result)
+    if mtime_ns is None:
+        PROBE_CACHE.pop(cache_key, None)
+    else:
+        PROBE_CACHE[cache_key] = {"mtime_ns": mtime_ns, "value": str(result)}
+    return result
+
+
+def rustup_which_uncached(command: str, *, toolchain: str) -> pathlib.Path:
     return pathlib.Path(
         subprocess.check_output(
             ["rustup", "which", "--toolchain", toolchain, "--", command],
@@ -840,6 +1020,24 @@ def rustup_which(command: str, *, toolchain: str) -> pathlib.Path:
     )
 
 
+# Where check_call sends the output of build and test commands. None means the
+# terminal.
+COMMAND_LOG: typing.Optional[typing.TextIO] = None
+
+
+def set_command_log(log: typing.Optional[typing.TextIO]) -> None:
+    global COMMAND_LOG
+    COMMAND_LOG = log
+
+
+def check_call(command: typing.List[typing.Any], **kwargs: typing.Any) -> None:
+    if COMMAND_LOG is not None:
+        COMMAND_LOG.flush()
+        kwargs.setdefault("stdout", COMMAND_LOG)
+        kwargs.setdefault("stderr", subprocess.STDOUT)
+    subprocess.check_call(command, **kwargs)
+
+
 def delete_dir(dir: pathlib.Path) -> None:
     try:
         shutil.rmtree(dir)
@@ -849,6 +1047,8 @@ def delete_dir(dir: pathlib.Path) -> None:
 
 cache_bust = 1
 
+CACHE_BUST_LINE_RE = re.compile(r"^// CACHE-BUST:[^\n]*\n", re.MULTILINE)
+
 
 def mutate_file(path: pathlib.Path) -> None:
     global cache_bust
@@ -861,12 +1061,8 @@ def mutate_file(path: pathlib.Path) -> None:
 
 
 def unmutate_file(path: pathlib.Path) -> None:
-    # Add a line at the top. This will force debug info to change.
-    old_text = path.read_text()
-    lines = old_text.splitlines()
-    lines = [l for l in lines if not re.match(r"^// CACHE-BUST:", l)]
-    new_text = "\n".join(lines) + "\n"
-    path.write_text(new_text)
+    # Remove the line(s) added by mutate_file.
+    path.write_text(CACHE_BUST_LINE_RE.sub("", path.read_text()))
 
 
 def find_unique_file(root: pathlib.Path, name: str) -> pathlib.Path:
@@ -878,17 +1074,24 @@ def find_unique_file(root: pathlib.Path, name: str) -> pathlib.Path:
     return paths[0]
 
 
-CXX_COMPILER_BUILDS_CACHE = {}
-
-
+@functools.lru_cache(maxsize=None)
 def cxx_compiler_builds(cxx_compiler: pathlib.Path, flags: str) -> bool:
-    cache_key = (str(cxx_compiler), flags)
-    cached = CXX_COMPILER_BUILDS_CACHE.get(cache_key, None)
-    if cached is not None:
-        return cached
+    cxx_compiler_path = shutil.which(str(cxx_compiler))
+    if cxx_compiler_path is None:
+        # Compiler does not exist.
+        return False
+
+    cache_key = probe_cache_key("cxx_compiler_builds", cxx_compiler_path, flags)
+    mtime_ns = get_mtime_ns(cxx_compiler_path)
+    cached = PROBE_CACHE.get(cache_key, None)
+    if cached is not None and cached["mtime_ns"] == mtime_ns:
+        return cached["value"]
 
     result = cxx_compiler_builds_uncached(cxx_compiler=cxx_compiler, flags=flags)
-    CXX_COMPILER_BUILDS_CACHE[cache_key] = result
+    if result:
+        # NOTE: Failures are not persisted. A failure can be fixed without
+        # touching the compiler (e.g. by installing libc++ or a linker).
+        PROBE_CACHE[cache_key] = {"mtime_ns": mtime_ns, "value": result}
     return result
 
 
@@ -907,5 +1110,34 @@ def cxx_compiler_builds_uncached(cxx_compiler: pathlib.Path, flags: str) -> bool
         return False
 
 
+# Results of rustup_which and cxx_compiler_builds, persisted across runs in
+# PROBE_CACHE_PATH. Each entry records the mtime of the file it depends on (the
+# compiler or the found executable); an entry is stale if that mtime changed.
+# Only successful probes are recorded.
+PROBE_CACHE: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+
+
+def load_probe_cache() -> None:
+    try:
+        PROBE_CACHE.update(json.loads(PROBE_CACHE_PATH.read_text()))
+    except (FileNotFoundError, json.JSONDecodeError):
+        pass
+
+
+def save_probe_cache() -> None:
+    PROBE_CACHE_PATH.write_text(json.dumps(PROBE_CACHE, indent=2, sort_keys=True))
+
+
+def probe_cache_key(*parts: str) -> str:
+    return hashlib.sha256(json.dumps(parts).encode("utf-8")).hexdigest()
+
+
+def get_mtime_ns(path: typing.Union[str, pathlib.Path]) -> typing.Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
 if __name__ == "__main__":
     main()
@@ -1,8 +1,9 @@
-import collections
 import unittest
 import math
 import pathlib
 import sqlite3
+import statistics
+import tempfile
 import typing
 
 MillisecondDuration = int
@@ -19,11 +20,28 @@ class DB:
         toolchain_label: str
         benchmark_name: str
         samples: typing.Tuple[NanosecondDuration, ...]
+        # CPU time of child processes. Samples recorded before these were
+        # tracked are omitted, so these can be shorter than 'samples'.
+        user_samples: typing.Tuple[NanosecondDuration, ...] = ()
+        sys_samples: typing.Tuple[NanosecondDuration, ...] = ()
+
+    _pending_samples: typing.List[
+        typing.Tuple[
+            "DB.RunID",
+            NanosecondDuration,
+            typing.Optional[NanosecondDuration],
+            typing.Optional[NanosecondDuration],
+        ]
+    ]
 
     def __init__(self, path: typing.Optional[pathlib.Path]) -> None:
         self._connection = sqlite3.connect(":memory:" if path is None else path)
+        self._pending_samples = []
 
         cursor = self._connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
         cursor.execute(
             """
             CREATE TABLE IF NOT EXISTS run (
@@ -44,6 +62,11 @@ class DB:
             )
         """
         )
+        (schema_version,) = cursor.execute("PRAGMA user_version").fetchone()
+        if schema_version < 1:
+            cursor.execute("ALTER TABLE sample ADD COLUMN user_ns NUMERIC")
+            cursor.execute("ALTER TABLE sample ADD COLUMN sys_ns NUMERIC")
+            cursor.execute("PRAGMA user_version = 1")
         self._connection.commit()
 
     def create_run(
@@ -57,36 +80,48 @@ class DB:
         """,
             (hostname, project, toolchain_label, benchmark_name),
         )
-        self._connection.commit()
+        # The run is committed along with its samples by flush().
         return cursor.lastrowid
 
     def add_sample_to_run(
-        self, run_id: "DB.RunID", duration_ns: NanosecondDuration
+        self,
+        run_id: "DB.RunID",
+        duration_ns: NanosecondDuration,
+        user_ns: typing.Optional[NanosecondDuration] = None,
+        sys_ns: typing.Optional[NanosecondDuration] = None,
     ) -> None:
-        cursor = self._connection.cursor()
-        cursor.execute(
-            """
-            INSERT INTO sample (run_id, duration_ns)
-            VALUES (?, ?)
-        """,
-            (run_id, duration_ns),
-        )
+        # Samples are buffered until flush() to avoid a commit per sample.
+        self._pending_samples.append((run_id, duration_ns, user_ns, sys_ns))
+
+    # Write buffered samples and commit everything written so far.
+    def flush(self) -> None:
+        if self._pending_samples:
+            cursor = self._connection.cursor()
+            cursor.executemany(
+                """
+                INSERT INTO sample (run_id, duration_ns, user_ns, sys_ns)
+                VALUES (?, ?, ?, ?)
+            """,
+                self._pending_samples,
+            )
+            self._pending_samples = []
         self._connection.commit()
 
     def load_all_runs(self) -> typing.List["DB.Run"]:
         return self._load_runs_with_filter(
-            samples_where_clause="",
-            samples_parameters=(),
             runs_where_clause="",
             runs_parameters=(),
         )
 
     def load_latest_runs(self) -> typing.List["DB.Run"]:
         return self._load_runs_with_filter(
-            samples_where_clause="",
-            samples_parameters=(),
-            runs_id_selector="MAX(id)",
-            runs_where_clause="GROUP BY hostname, project, toolchain_label, benchmark_name",
+            runs_where_clause="""
+                WHERE run.id IN (
+                    SELECT MAX(id)
+                    FROM run
+                    GROUP BY hostname, project, toolchain_label, benchmark_name
+                )
+            """,
             runs_parameters=(),
         )
 
@@ -94,41 +129,56 @@ class DB:
         self, run_ids: typing.Sequence["DB.RunID"]
     ) -> typing.List["DB.Run"]:
         return self._load_runs_with_filter(
-            samples_where_clause=f"WHERE run_id IN ({', '.join('?' for _ in run_ids)})",
-            samples_parameters=tuple(run_ids),
-            runs_where_clause=f"WHERE id IN ({', '.join('?' for _ in run_ids)})",
+            runs_where_clause=f"WHERE run.id IN ({', '.join('?' for _ in run_ids)})",
             runs_parameters=tuple(run_ids),
         )
 
     def _load_runs_with_filter(
         self,
-        samples_where_clause: str,
-        samples_parameters,
         runs_where_clause: str,
         runs_parameters,
-        runs_id_selector: str = "id",
     ) -> typing.List["DB.Run"]:
+        self.flush()
         cursor = self._connection.cursor()
 
-        raw_samples = cursor.execute(
-            f"""
-                SELECT run_id, duration_ns
-                FROM sample
-                {samples_where_clause}
-            """,
-            samples_parameters,
-        ).fetchall()
-        run_samples = collections.defaultdict(list)
-        for (run_id, duration_ns) in raw_samples:
-            run_samples[run_id].append(duration_ns)
-
+        # Samples are concatenated by SQLite. GROUP_CONCAT's order is only
+        # defined when used as a window function, so use one to keep each run's
+        # samples in insertion order. GROUP_CONCAT skips NULLs, so samples
+        # without CPU times are left out of user_ns and sys_ns.
+        #
+        # runs_where_clause is applied to the samples too, so the window only
+        # covers the samples of the requested runs.
         raw_runs = cursor.execute(
             f"""
-                SELECT {runs_id_selector} AS run_id, hostname, project, toolchain_label, benchmark_name
+                SELECT
+                    run.id,
+                    run.hostname,
+                    run.project,
+                    run.toolchain_label,
+                    run.benchmark_name,
+                    run_samples.duration_ns,
+                    run_samples.user_ns,
+                    run_samples.sys_ns
                 FROM run
+                LEFT JOIN (
+                    SELECT DISTINCT
+                        run_id,
+                        GROUP_CONCAT(duration_ns) OVER run_window AS duration_ns,
+                        GROUP_CONCAT(user_ns) OVER run_window AS user_ns,
+                        GROUP_CONCAT(sys_ns) OVER run_window AS sys_ns
+                    FROM sample
+                    WHERE run_id IN (SELECT id FROM run {runs_where_clause})
+                    WINDOW run_window AS (
+                        PARTITION BY run_id
+                        ORDER BY rowid
+                        ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING
+                    )
+                ) AS run_samples
+                    ON run_samples.run_id = run.id
                 {runs_where_clause}
+                ORDER BY run.id
             """,
-            runs_parameters,
+            (*runs_parameters, *runs_parameters),
         ).fetchall()
         runs = [
             DB.Run(
@@ -137,7 +187,9 @@ class DB:
                 project=project,
                 toolchain_label=toolchain_label,
                 benchmark_name=benchmark_name,
-                samples=tuple(run_samples[run_id]),
+                samples=parse_concatenated_samples(samples),
+                user_samples=parse_concatenated_samples(user_samples),
+                sys_samples=parse_concatenated_samples(sys_samples),
             )
             for (
                 run_id,
@@ -145,6 +197,9 @@ class DB:
                 project,
                 toolchain_label,
                 benchmark_name,
+                samples,
+                user_samples,
+                sys_samples,
             ) in raw_runs
         ]
 
@@ -157,8 +212,17 @@ class DB:
             "toolchain",
             "benchmark",
             "min(ms)",
-            "avg(ms)",
+            "median(ms)",
+            "p95(ms)",
             "max(ms)",
+            "user min(ms)",
+            "user median(ms)",
+            "user p95(ms)",
+            "user max(ms)",
+            "sys min(ms)",
+            "sys median(ms)",
+            "sys p95(ms)",
+            "sys max(ms)",
         )
         rows = [
             (
@@ -166,9 +230,9 @@ class DB:
                 run.project,
                 run.toolchain_label,
                 run.benchmark_name,
-                ns_to_ms(min(run.samples)) if run.samples else "---",
-                ns_to_ms(avg(run.samples)) if run.samples else "---",
-                ns_to_ms(max(run.samples)) if run.samples else "---",
+                *summarize_samples(run.samples),
+                *summarize_samples(run.user_samples),
+                *summarize_samples(run.sys_samples),
             )
             for run in runs
         ]
@@ -215,6 +279,82 @@ class TestDB(unittest.TestCase):
         self.assertEqual(len(runs), 1)
         self.assertEqual(runs[0].samples, (100, 200, 300))
 
+    def test_load_run_with_cpu_times(self) -> None:
+        db = DB(path=None)
+        run_id = db.create_run("myhostname", "myproject", "mytoolchain", "mybenchmark")
+        db.add_sample_to_run(run_id=run_id, duration_ns=100, user_ns=80, sys_ns=10)
+        db.add_sample_to_run(run_id=run_id, duration_ns=200)
+        runs = db.load_runs_by_ids([run_id])
+        self.assertEqual(runs[0].samples, (100, 200))
+        self.assertEqual(runs[0].user_samples, (80,))
+        self.assertEqual(runs[0].sys_samples, (10,))
+
+    def test_load_runs_by_ids_excludes_other_runs_samples(self) -> None:
+        db = DB(path=None)
+        run_1_id = db.create_run("myhostname", "myproject", "mytoolchain", "bench1")
+        run_2_id = db.create_run("myhostname", "myproject", "mytoolchain", "bench2")
+        run_3_id = db.create_run("myhostname", "myproject", "mytoolchain", "bench3")
+        db.add_sample_to_run(run_id=run_1_id, duration_ns=100)
+        db.add_sample_to_run(run_id=run_2_id, duration_ns=200)
+        db.add_sample_to_run(run_id=run_3_id, duration_ns=300)
+        db.add_sample_to_run(run_id=run_2_id, duration_ns=250)
+        runs = db.load_runs_by_ids([run_2_id])
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(runs[0].id, run_2_id)
+        self.assertEqual(runs[0].samples, (200, 250))
+
+    def test_p95_uses_nearest_rank(self) -> None:
+        self.assertEqual(p95([300, 100, 200]), 300)
+        self.assertEqual(p95(range(1, 21)), 19)
+        self.assertEqual(p95(range(1, 101)), 95)
+        self.assertEqual(p95([42]), 42)
+
+    def test_summarize_samples(self) -> None:
+        self.assertEqual(summarize_samples(()), ("---", "---", "---", "---"))
+        self.assertEqual(
+            summarize_samples((3_000_000, 1_000_000, 2_000_000)), (1, 2, 3, 3)
+        )
+
+    def test_old_database_is_upgraded(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = pathlib.Path(temp_dir) / "test.db"
+            connection = sqlite3.connect(db_path)
+            connection.execute(
+                "CREATE TABLE sample (run_id INTEGER, duration_ns NUMERIC)"
+            )
+            connection.execute("INSERT INTO sample VALUES (1, 100)")
+            connection.commit()
+            connection.close()
+
+            db = DB(path=db_path)
+            run_id = db.create_run(
+                "myhostname", "myproject", "mytoolchain", "mybenchmark"
+            )
+            db.add_sample_to_run(run_id=run_id, duration_ns=200, user_ns=150, sys_ns=20)
+            runs = db.load_runs_by_ids([run_id])
+            self.assertEqual(runs[0].user_samples, (150,))
+
+    def test_unflushed_runs_are_not_visible_to_other_connections(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = pathlib.Path(temp_dir) / "test.db"
+            db = DB(path=db_path)
+            db.create_run("myhostname", "myproject", "mytoolchain", "mybenchmark")
+            self.assertEqual(DB(path=db_path).load_all_runs(), [])
+
+    def test_flushed_samples_are_visible_to_other_connections(self) -> None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            db_path = pathlib.Path(temp_dir) / "test.db"
+            db = DB(path=db_path)
+            run_id = db.create_run(
+                "myhostname", "myproject", "mytoolchain", "mybenchmark"
+            )
+            db.add_sample_to_run(run_id=run_id, duration_ns=100)
+            db.add_sample_to_run(run_id=run_id, duration_ns=200)
+            db.flush()
+            runs = DB(path=db_path).load_runs_by_ids([run_id])
+            self.assertEqual(len(runs), 1)
+            self.assertEqual(runs[0].samples, (100, 200))
+
     def test_load_latest_runs_with_no_obsoleted_runs(self) -> None:
         db = DB(path=None)
         # fmt: off
@@ -250,6 +390,22 @@ class TestDB(unittest.TestCase):
         self.assertEqual(len(runs), 1)
         self.assertEqual(runs[0].id, run_2_id)
 
+    def test_load_latest_runs_includes_samples(self) -> None:
+        db = DB(path=None)
+        run_1_id = db.create_run(
+            "myhostname", "myproject", "mytoolchain", "mybenchmark"
+        )
+        db.add_sample_to_run(run_id=run_1_id, duration_ns=100)
+        run_2_id = db.create_run(
+            "myhostname", "myproject", "mytoolchain", "mybenchmark"
+        )
+        db.add_sample_to_run(run_id=run_2_id, duration_ns=300)
+        db.add_sample_to_run(run_id=run_2_id, duration_ns=200)
+        runs = db.load_latest_runs()
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(runs[0].id, run_2_id)
+        self.assertEqual(runs[0].samples, (300, 200))
+
     def test_load_all_runs_includes_obsoleted_runs(self) -> None:
         db = DB(path=None)
         run_1_id = db.create_run(
@@ -270,5 +426,32 @@ def ns_to_ms(ns: NanosecondDuration) -> MillisecondDuration:
     return int(math.ceil(ns / 1e6))
 
 
+def parse_concatenated_samples(
+    samples: typing.Optional[str],
+) -> typing.Tuple[NanosecondDuration, ...]:
+    if samples is None:
+        return ()
+    return tuple(int(sample) for sample in samples.split(","))
+
+
+def summarize_samples(
+    samples: typing.Sequence[NanosecondDuration],
+) -> typing.Tuple[typing.Union[MillisecondDuration, str], ...]:
+    if not samples:
+        return ("---", "---", "---", "---")
+    return (
+        ns_to_ms(min(samples)),
+        ns_to_ms(statistics.median(samples)),
+        ns_to_ms(p95(samples)),
+        ns_to_ms(max(samples)),
+    )
+
+
 def avg(xs):
     return sum(xs) / len(xs)
+
+
+def p95(xs):
+    # Nearest-rank percentile.
+    sorted_xs = sorted(xs)
+    return sorted_xs[math.ceil(0.95 * len(sorted_xs)) - 1]
@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 
+import concurrent.futures
+import functools
+import os
 import pathlib
 import re
 import shutil
 import subprocess
+import sys
 import typing
 
 ROOT = pathlib.Path(__file__).parent / ".."
 
-macros = [
+macros = (
     "assert_matches",
     "qljs_always_assert",
     "qljs_assert",
@@ -27,89 +31,139 @@ macros = [
     "qljs_match_diag_field",
     "qljs_case_binary_only_operator_symbol_except_less_less_and_star",
     "qljs_case_binary_only_operator_symbol_except_star",
-    "qljs_case_binary_only_operator_symbol_except_star",
     "qljs_case_binary_only_operator_symbol",
     "qljs_case_compound_assignment_operator_except_slash_equal",
-    "qljs_case_binary_only_operator_symbol",
     "qljs_match_diag_fields",
     "qljs_never_assert",
     "qljs_offset_of",
     "qljs_slow_assert",
     "qljs_translatable",
     "scoped_trace",
-]
+)
+
+# Matches lexer identifiers and #include-s of the lexer's header.
+LEX_MODULE_REFERENCE_RE = re.compile(
+    rb"\b(?:lexer(?:_transaction)?|test_lex)\b|(?P<header>quick-lint-js/fe/lex\.h)"
+)
 
 
 def main() -> None:
+    # Projects in later waves use projects from earlier waves as templates.
+    waves = [
+        [
+            generate_rust_threecrate_cratecargotest,
+            generate_rust_workspace_crateunotest,
+            generate_rust_workspace_cratecargotest_nodefaultfeatures,
+            generate_rust_twocrate_cratecargotest,
+        ]
+        + [
+            functools.partial(
+                generate_rust_workspace_cratecargotest_n, total_copies=total_copies
+            )
+            for total_copies in (8, 16, 24)
+        ]
+        + [
+            functools.partial(generate_cpp_n, total_copies=total_copies)
+            for total_copies in (8, 16, 24)
+        ],
+        [
+            generate_rust_twocrate_unittest,
+            generate_rust_threecrate_crateunotest,
+        ],
+    ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        for wave in waves:
+            futures = [executor.submit(generate) for generate in wave]
+            for future in futures:
+                future.result()
+
+
+def generate_rust_threecrate_cratecargotest() -> None:
     project_dir = ROOT / "rust-threecrate-cratecargotest"
     new_project_from_template(project_dir, template_dir=ROOT / "rust")
     workspace_to_threecrate(project_dir)
     fix_cargo_lock(project_dir)
 
+
+def generate_rust_workspace_crateunotest() -> None:
     project_dir = ROOT / "rust-workspace-crateunotest"
     new_project_from_template(project_dir, template_dir=ROOT / "rust")
     cargotest_to_unotest(project_dir)
     fix_cargo_lock(project_dir)
 
+
+def generate_rust_workspace_cratecargotest_nodefaultfeatures() -> None:
     project_dir = ROOT / "rust-workspace-cratecargotest-nodefaultfeatures"
     new_project_from_template(project_dir, template_dir=ROOT / "rust")
     disable_default_crate_features(project_dir)
     fix_cargo_lock(project_dir)
 
+
+def generate_rust_twocrate_cratecargotest() -> None:
     project_dir = ROOT / "rust-twocrate-cratecargotest"
     new_project_from_template(project_dir, template_dir=ROOT / "rust")
     workspace_to_twocrate(project_dir)
     fix_cargo_lock(project_dir)
 
+
+def generate_rust_twocrate_unittest() -> None:
     project_dir = ROOT / "rust-twocrate-unittest"
     new_project_from_template(
         project_dir, template_dir=ROOT / "rust-twocrate-cratecargotest"
     )
     cargotest_to_unittest(project_dir)
-    fix_cargo_lock(project_dir)
+    # The template's dependencies were fetched when it was generated.
+    fix_cargo_lock(project_dir, offline=True)
 
+
+def generate_rust_threecrate_crateunotest() -> None:
     project_dir = ROOT / "rust-threecrate-crateunotest"
     new_project_from_template(
         project_dir, template_dir=ROOT / "rust-threecrate-cratecargotest"
     )
     cargotest_to_unotest(project_dir)
+    # The template's dependencies were fetched when it was generated.
+    fix_cargo_lock(project_dir, offline=True)
+
+
+def generate_rust_workspace_cratecargotest_n(total_copies: int) -> None:
+    project_dir = ROOT / f"rust-workspace-cratecargotest-{total_copies}"
+    new_project_from_template(project_dir, template_dir=ROOT / "rust")
+    multiply_lex_module_rs(project_dir, total_copies=total_copies)
     fix_cargo_lock(project_dir)
 
-    for total_copies in (8, 16, 24):
-        project_dir = ROOT / f"rust-workspace-cratecargotest-{total_copies}"
-        new_project_from_template(project_dir, template_dir=ROOT / "rust")
-        multiply_lex_module_rs(project_dir, total_copies=total_copies)
-        fix_cargo_lock(project_dir)
 
-    for total_copies in (8, 16, 24):
-        project_dir = ROOT / f"cpp-{total_copies}"
-        new_project_from_template(project_dir, template_dir=ROOT / "cpp")
-        multiply_lex_module_cpp(project_dir, total_copies=total_copies)
+def generate_cpp_n(total_copies: int) -> None:
+    project_dir = ROOT / f"cpp-{total_copies}"
+    new_project_from_template(project_dir, template_dir=ROOT / "cpp")
+    multiply_lex_module_cpp(project_dir, total_copies=total_copies)
 
 
 def new_project_from_template(
     project_dir: pathlib.Path, template_dir: pathlib.Path
 ) -> None:
     delete_dir(project_dir)
-    shutil.copytree(template_dir, project_dir, symlinks=True)
+    copy_tree(template_dir, project_dir)
     (project_dir / "README").write_text(
         "THIS PROJECT WAS GENERATED BY generate-rust-project.py\n"
     )
 
 
 def cargotest_to_unotest(project_dir: pathlib.Path) -> None:
-    tests_dirs = list(project_dir.glob("**/tests"))
+    tests_dirs = find_paths_named(project_dir, "tests")
     for test_dir in tests_dirs:
         mod_dir = test_dir / "t"
         mod_dir.mkdir(exist_ok=False)
 
-        mod_file = ""
-        for test_file in sorted(test_dir.glob("test_*.rs")):
+        test_mod_names = []
+        for test_file in list_files(test_dir, prefix="test_", suffix=".rs"):
             test_file.rename(mod_dir / test_file.name)
-            mod_file += f"mod {test_file.stem};\n"
+            test_mod_names.append(test_file.stem)
 
         (test_dir / "test.rs").write_text(f"mod {mod_dir.name};\n")
-        (mod_dir / "mod.rs").write_text(mod_file)
+        (mod_dir / "mod.rs").write_text(
+            "".join(f"mod {name};\n" for name in sorted(test_mod_names))
+        )
 
 
 def workspace_to_twocrate(project_dir: pathlib.Path) -> None:
@@ -123,53 +177,78 @@ def workspace_to_threecrate(project_dir: pathlib.Path) -> None:
 def workspace_to_fewcrate(
     project_dir: pathlib.Path, libs_to_keep: typing.Tuple[str, ...]
 ) -> None:
-    crate_dirs = sorted(d for d in project_dir.glob("libs/*"))
+    # NOTE: The order of crate_names determines the order of lib.rs's mod
+    # declarations.
+    crate_dirs = sorted(list_dirs(project_dir / "libs"))
     crate_names = [d.name for d in crate_dirs]
+    # libs_to_keep's order determines the order of the Cargo.toml entries.
+    kept_crate_names = frozenset(libs_to_keep)
+
+    # Matches references to crates which are being merged into the top-level
+    # crate ('cpp_vs_rust_fe::'), and references to the current crate
+    # ('crate::'), optionally followed by the name of an exported macro.
+    #
+    # NOTE: Macro names match as prefixes, so 'qljs_assert' also covers
+    # 'qljs_assert_trap', and 'qljs_case_contextual_keyword' covers
+    # 'qljs_case_contextual_keyword_except_async_and_get_and_set'. Because
+    # every macro rewrite has the same shape, the order of the alternatives
+    # does not matter.
+    crate_reference_re = re.compile(
+        r"(?:cpp_vs_rust_(?P<crate>"
+        + "|".join(re.escape(c) for c in crate_names if c not in kept_crate_names)
+        + r")|crate)::(?P<macro>"
+        + "|".join(re.escape(m) for m in macros)
+        + r")?"
+    )
 
     def fix_rs(rs: pathlib.Path, current_crate_name: str, crate_reference: str) -> None:
-        source = rs.read_text()
-        if current_crate_name not in libs_to_keep:
-            source = source.replace("crate::", f"cpp_vs_rust_{current_crate_name}::")
-        for crate_name in crate_names:
-            if crate_name in libs_to_keep:
-                continue
-            for macro in macros:
-                source = source.replace(
-                    f"cpp_vs_rust_{crate_name}::{macro}", f"{crate_reference}::{macro}"
-                )
-            source = source.replace(
-                f"cpp_vs_rust_{crate_name}::", f"{crate_reference}::{crate_name}::"
-            )
+        def fix_crate_reference(match: typing.Match[str]) -> str:
+            crate_name = match.group("crate")
+            if crate_name is None:
+                if current_crate_name in kept_crate_names:
+                    return match.group(0)
+                crate_name = current_crate_name
+            macro = match.group("macro")
+            if macro is not None:
+                return f"{crate_reference}::{macro}"
+            return f"{crate_reference}::{crate_name}::"
+
+        original_source = rs.read_text()
+        if "crate::" not in original_source and "cpp_vs_rust_" not in original_source:
+            # Nothing to rewrite.
+            return
+        source = crate_reference_re.sub(fix_crate_reference, original_source)
         source = source.replace(
             "\n        use crate::qljs_crash_allowing_core_dump;\n",
             "\n        use $crate::qljs_crash_allowing_core_dump;\n",
         )
-        rs.write_text(source)
+        if source != original_source:
+            rs.write_text(source)
 
     for crate_dir in crate_dirs:
         crate_name = crate_dir.name
 
-        if crate_name in libs_to_keep:
-            for src in crate_dir.glob("src/*.rs"):
+        if crate_name in kept_crate_names:
+            for src in list_files(crate_dir / "src", suffix=".rs"):
                 fix_rs(src, crate_name, "cpp_vs_rust")
-            for src in crate_dir.glob("tests/*.rs"):
+            for src in list_files(crate_dir / "tests", suffix=".rs"):
                 fix_rs(src, crate_name, "cpp_vs_rust")
         else:
             new_src_dir = project_dir / "src" / crate_name
             new_src_dir.mkdir(exist_ok=True, parents=True)
-            for src in crate_dir.glob("src/*.rs"):
+            for src in list_files(crate_dir / "src", suffix=".rs"):
                 fix_rs(src, crate_name, "crate")
                 src.rename(new_src_dir / src.name)
 
             new_tests_dir = project_dir / "tests"
             new_tests_dir.mkdir(exist_ok=True, parents=True)
-            for test in crate_dir.glob("tests/*.rs"):
+            for test in list_files(crate_dir / "tests", suffix=".rs"):
                 fix_rs(test, crate_name, "cpp_vs_rust")
                 test.rename(new_tests_dir / test.name)
 
             (new_src_dir / "lib.rs").rename(new_src_dir / "mod.rs")
 
-    if "test" in libs_to_keep:
+    if "test" in kept_crate_names:
         cargo_toml_path = project_dir / "libs" / "test" / "Cargo.toml"
         cargo_toml = cargo_toml_path.read_text()
         for crate_name in crate_names:
@@ -181,23 +260,26 @@ def workspace_to_fewcrate(
         )
         cargo_toml_path.write_text(cargo_toml)
 
-    lib_rs = ""
-    for crate_name in crate_names:
-        if crate_name not in libs_to_keep:
-            lib_rs += f"pub mod {crate_name};\n"
-
-    (project_dir / "src" / "lib.rs").write_text(lib_rs)
+    (project_dir / "src" / "lib.rs").write_text(
+        "".join(
+            f"pub mod {crate_name};\n"
+            for crate_name in crate_names
+            if crate_name not in kept_crate_names
+        )
+    )
 
-    dependencies = ""
-    dev_dependencies = ""
+    dependency_lines = []
+    dev_dependency_lines = []
     for lib_to_keep in libs_to_keep:
         line = f'cpp_vs_rust_{lib_to_keep} = {{ path = "libs/{lib_to_keep}" }}\n'
         if lib_to_keep == "test":
-            dev_dependencies += line
+            dev_dependency_lines.append(line)
         else:
-            dependencies += line
-    if "test" not in libs_to_keep:
-        dependencies += '\nlazy_static = { version = "1.4.0" }\n'
+            dependency_lines.append(line)
+    if "test" not in kept_crate_names:
+        dependency_lines.append('\nlazy_static = { version = "1.4.0" }\n')
+    dependencies = "".join(dependency_lines)
+    dev_dependencies = "".join(dev_dependency_lines)
 
     cargo_toml_path = project_dir / "Cargo.toml"
     cargo_toml = cargo_toml_path.read_text()
@@ -232,15 +314,15 @@ qljs_debug = []
 
 
 def cargotest_to_unittest(project_dir: pathlib.Path) -> None:
-    test_files = sorted(project_dir.glob("tests/test_*.rs"))
-
-    for test_file in test_files:
+    test_mod_names = []
+    for test_file in list_files(project_dir / "tests", prefix="test_", suffix=".rs"):
         test_file.write_text(test_file.read_text().replace(f"cpp_vs_rust::", "crate::"))
         test_file.rename(project_dir / "src" / test_file.name)
+        test_mod_names.append(test_file.stem)
 
-    mod_file = ""
-    for test_file in test_files:
-        mod_file += f"#[cfg(test)]\nmod {test_file.stem};\n"
+    mod_file = "".join(
+        f"#[cfg(test)]\nmod {name};\n" for name in sorted(test_mod_names)
+    )
     lib_rs = project_dir / "src" / "lib.rs"
     lib_rs.write_text(lib_rs.read_text() + "\n" + mod_file)
 
@@ -254,7 +336,7 @@ def cargotest_to_unittest(project_dir: pathlib.Path) -> None:
 
 def disable_default_crate_features(project_dir: pathlib.Path) -> None:
     did_update_cargo_toml = False
-    for cargo_toml_path in project_dir.glob("**/Cargo.toml"):
+    for cargo_toml_path in find_paths_named(project_dir, "Cargo.toml"):
         cargo_toml = cargo_toml_path.read_text()
         updated_cargo_toml = cargo_toml.replace(
             'libc = { version = "0.2.138" }',
@@ -271,24 +353,22 @@ def multiply_lex_module_rs(project_dir: pathlib.Path, total_copies: int) -> None
     assert total_copies > 1
 
     original_test_lex_rs = project_dir / "libs" / "fe" / "tests" / "test_lex.rs"
-    original_test_lex_rs_code = original_test_lex_rs.read_text()
+    original_test_lex_rs_code = original_test_lex_rs.read_bytes()
+    new_test_lex_rs_prefix = str(original_test_lex_rs.with_suffix(""))
     for i in range(1, total_copies):
-        new_test_lex_rs = (
-            original_test_lex_rs.parent / f"{original_test_lex_rs.stem}_{i}.rs"
-        )
-        new_test_lex_rs.write_text(
-            original_test_lex_rs_code.replace("::lex::", f"::lex_{i}::")
+        write_bytes(
+            f"{new_test_lex_rs_prefix}_{i}.rs",
+            original_test_lex_rs_code.replace(b"::lex::", f"::lex_{i}::".encode()),
         )
 
     original_lex_rs = project_dir / "libs" / "fe" / "src" / "lex.rs"
-    original_lex_rs_code = original_lex_rs.read_text()
+    new_lex_rs_prefix = str(original_lex_rs.with_suffix(""))
     for i in range(1, total_copies):
-        new_lex_rs = original_lex_rs.parent / f"{original_lex_rs.stem}_{i}.rs"
-        new_lex_rs.write_text(original_lex_rs_code)
+        shutil.copyfile(original_lex_rs, f"{new_lex_rs_prefix}_{i}.rs")
 
-    new_mods = "pub mod lex;\n"
-    for i in range(1, total_copies):
-        new_mods += f"pub mod lex_{i};\n"
+    new_mods = "pub mod lex;\n" + "".join(
+        f"pub mod lex_{i};\n" for i in range(1, total_copies)
+    )
     lib_rs = project_dir / "libs" / "fe" / "src" / "lib.rs"
     lib_rs.write_text(lib_rs.read_text().replace("pub mod lex;\n", new_mods))
 
@@ -296,56 +376,134 @@ def multiply_lex_module_rs(project_dir: pathlib.Path, total_copies: int) -> None
 def multiply_lex_module_cpp(project_dir: pathlib.Path, total_copies: int) -> None:
     assert total_copies > 1
 
-    def fix_source(source: str, i: int) -> str:
-        return re.sub(
-            r"\b(lexer(_transaction)?|test_lex)\b",
-            lambda math: f"{math.group(0)}_{i}",
-            source,
-        ).replace("quick-lint-js/fe/lex.h", f"quick-lint-js/fe/lex-{i}.h")
+    def fix_source(source: bytes, i: int) -> bytes:
+        suffix = f"_{i}".encode()
+        header = f"quick-lint-js/fe/lex-{i}.h".encode()
+
+        def fix_reference(match: typing.Match[bytes]) -> bytes:
+            if match.group("header") is not None:
+                return header
+            return match.group(0) + suffix
+
+        return LEX_MODULE_REFERENCE_RE.sub(fix_reference, source)
 
     original_test_lex_cpp = project_dir / "test" / "test-lex.cpp"
-    original_test_lex_cpp_code = original_test_lex_cpp.read_text()
+    original_test_lex_cpp_code = original_test_lex_cpp.read_bytes()
+    new_test_lex_cpp_prefix = str(original_test_lex_cpp.with_suffix(""))
     for i in range(1, total_copies):
-        new_test_lex_cpp = (
-            original_test_lex_cpp.parent / f"{original_test_lex_cpp.stem}-{i}.cpp"
+        write_bytes(
+            f"{new_test_lex_cpp_prefix}-{i}.cpp",
+            fix_source(original_test_lex_cpp_code, i=i),
         )
-        new_test_lex_cpp.write_text(fix_source(original_test_lex_cpp_code, i=i))
 
     original_lex_cpp = project_dir / "src" / "quick-lint-js" / "fe" / "lex.cpp"
-    original_lex_cpp_code = original_lex_cpp.read_text()
+    original_lex_cpp_code = original_lex_cpp.read_bytes()
+    new_lex_cpp_prefix = str(original_lex_cpp.with_suffix(""))
     for i in range(1, total_copies):
-        new_lex_cpp = original_lex_cpp.parent / f"{original_lex_cpp.stem}-{i}.cpp"
-        new_lex_cpp.write_text(fix_source(original_lex_cpp_code, i=i))
+        write_bytes(
+            f"{new_lex_cpp_prefix}-{i}.cpp", fix_source(original_lex_cpp_code, i=i)
+        )
 
     original_lex_h = project_dir / "src" / "quick-lint-js" / "fe" / "lex.h"
-    original_lex_h_code = original_lex_h.read_text()
+    original_lex_h_code = original_lex_h.read_bytes()
+    new_lex_h_prefix = str(original_lex_h.with_suffix(""))
     for i in range(1, total_copies):
-        new_lex_h = original_lex_h.parent / f"{original_lex_h.stem}-{i}.h"
-        new_lex_h.write_text(fix_source(original_lex_h_code, i=i))
+        write_bytes(f"{new_lex_h_prefix}-{i}.h", fix_source(original_lex_h_code, i=i))
 
     original_src_files = "  quick-lint-js/fe/lex.cpp\n  quick-lint-js/fe/lex.h"
-    new_src_files = original_src_files
-    for i in range(1, total_copies):
-        new_src_files += (
-            f"\n  quick-lint-js/fe/lex-{i}.cpp\n  quick-lint-js/fe/lex-{i}.h"
-        )
+    new_src_files = original_src_files + "".join(
+        f"\n  quick-lint-js/fe/lex-{i}.cpp\n  quick-lint-js/fe/lex-{i}.h"
+        for i in range(1, total_copies)
+    )
     src_cmakelists_txt = project_dir / "src" / "CMakeLists.txt"
     src_cmakelists_txt.write_text(
         src_cmakelists_txt.read_text().replace(original_src_files, new_src_files)
     )
 
     original_test_files = "  test-lex.cpp"
-    new_test_files = original_test_files
-    for i in range(1, total_copies):
-        new_test_files += f"\n  test-lex-{i}.cpp"
+    new_test_files = original_test_files + "".join(
+        f"\n  test-lex-{i}.cpp" for i in range(1, total_copies)
+    )
     test_cmakelists_txt = project_dir / "test" / "CMakeLists.txt"
     test_cmakelists_txt.write_text(
         test_cmakelists_txt.read_text().replace(original_test_files, new_test_files)
     )
 
 
-def fix_cargo_lock(project_dir: pathlib.Path) -> None:
-    subprocess.check_call(["cargo", "fetch"], cwd=project_dir)
+def fix_cargo_lock(project_dir: pathlib.Path, offline: bool = False) -> None:
+    # Many projects keep their template's dependency graph, in which case the
+    # Cargo.lock copied from the template is already correct and its crates
+    # are already downloaded. Check that without resolving or touching the
+    # network first.
+    try:
+        subprocess.check_call(
+            ["cargo", "fetch", "--locked", "--offline"],
+            cwd=project_dir,
+            stderr=subprocess.DEVNULL,
+        )
+        return
+    except subprocess.CalledProcessError:
+        pass
+
+    command = ["cargo", "fetch"]
+    if offline:
+        command.append("--offline")
+    subprocess.check_call(command, cwd=project_dir)
+
+
+def copy_tree(source_dir: pathlib.Path, destination_dir: pathlib.Path) -> None:
+    # Reflinks are copy-on-write, so editing the copy leaves the template
+    # alone. Hard links would not: the generators modify files in place.
+    if sys.platform.startswith("linux"):
+        try:
+            subprocess.check_call(
+                [
+                    "cp",
+                    "--archive",
+                    "--reflink=auto",
+                    "--",
+                    str(source_dir),
+                    str(destination_dir),
+                ]
+            )
+            return
+        except (OSError, subprocess.CalledProcessError):
+            delete_dir(destination_dir)
+    shutil.copytree(source_dir, destination_dir, symlinks=True)
+
+
+def list_files(
+    dir: pathlib.Path, suffix: str, prefix: str = ""
+) -> typing.List[pathlib.Path]:
+    try:
+        with os.scandir(dir) as entries:
+            return [
+                pathlib.Path(entry.path)
+                for entry in entries
+                if entry.name.startswith(prefix)
+                and entry.name.endswith(suffix)
+                and entry.is_file()
+            ]
+    except FileNotFoundError:
+        return []
+
+
+def list_dirs(dir: pathlib.Path) -> typing.List[pathlib.Path]:
+    with os.scandir(dir) as entries:
+        return [pathlib.Path(entry.path) for entry in entries if entry.is_dir()]
+
+
+def find_paths_named(dir: pathlib.Path, name: str) -> typing.List[pathlib.Path]:
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(dir):
+        if name in dirnames or name in filenames:
+            paths.append(pathlib.Path(dirpath) / name)
+    return paths
+
+
+def write_bytes(path: str, data: bytes) -> None:
+    with open(path, "wb") as file:
+        file.write(data)
 
 
 def delete_dir(dir: pathlib.Path) -> None: